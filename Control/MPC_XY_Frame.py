@@ -6,8 +6,14 @@ author: huiming zhou
 import os
 import sys
 import math
-import cvxpy
+import hashlib
+import inspect
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import osqp
 import numpy as np
+import scipy.sparse as sparse
+from numba import njit
 import matplotlib.pyplot as plt
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) +
@@ -33,12 +39,15 @@ class P:
     dist_stop = 1.5  # stop permitted when dist to goal < dist_stop
     speed_stop = 0.5 / 3.6  # stop permitted when speed < speed_stop
     time_max = 500.0  # max simulation time
-    iter_max = 5  # max iteration
+    iter_max = 5  # max iteration when the last control step did not converge
+    iter_min = 1  # iteration when the last control step converged
     target_speed = 10.0 / 3.6  # target speed
     N_IND = 10  # search index number
     dt = 0.2  # time step
     d_dist = 1.0  # dist step
     du_res = 0.1  # threshold for stopping iteration
+    mpc_async = False  # solve the mpc in a worker process, see main()
+    mpc_delay = 1  # [steps] latency of an asynchronous solve, 1 <= mpc_delay < T
 
     # vehicle config
     RF = 3.3  # [m] distance from rear to vehicle front end of vehicle
@@ -58,47 +67,67 @@ class P:
 
 class Node:
     def __init__(self, x=0.0, y=0.0, yaw=0.0, v=0.0, direct=1.0):
-        self.x = x
-        self.y = y
-        self.yaw = yaw
-        self.v = v
+        self._state = np.array([x, y, yaw, v], dtype=np.float64)
         self.direct = direct
 
-    def update(self, a, delta, direct):
-        delta = self.limit_input_delta(delta)
-        self.x += self.v * math.cos(self.yaw) * P.dt
-        self.y += self.v * math.sin(self.yaw) * P.dt
-        self.yaw += self.v / P.WB * math.tan(delta) * P.dt
-        self.direct = direct
-        self.v += self.direct * a * P.dt
-        self.v = self.limit_speed(self.v)
+    @property
+    def x(self):
+        return self._state[0]
+
+    @x.setter
+    def x(self, value):
+        self._state[0] = value
+
+    @property
+    def y(self):
+        return self._state[1]
+
+    @y.setter
+    def y(self, value):
+        self._state[1] = value
+
+    @property
+    def yaw(self):
+        return self._state[2]
 
-    @staticmethod
-    def limit_input_delta(delta):
-        if delta >= P.steer_max:
-            return P.steer_max
+    @yaw.setter
+    def yaw(self, value):
+        self._state[2] = value
 
-        if delta <= -P.steer_max:
-            return -P.steer_max
+    @property
+    def v(self):
+        return self._state[3]
 
-        return delta
+    @v.setter
+    def v(self, value):
+        self._state[3] = value
 
-    @staticmethod
-    def limit_speed(v):
-        if v >= P.speed_max:
-            return P.speed_max
+    def update(self, a, delta, direct):
+        self.direct = direct
+        _node_step(self._state, a, delta, direct, P.dt, P.WB,
+                   P.steer_max, P.speed_max, P.speed_min)
+
+
+@njit(cache=True, fastmath=True)
+def _node_step(state, a, delta, direct, dt, WB, steer_max, speed_max, speed_min):
+    """
+    one step of the kinematic model, updates state = [x, y, yaw, v] in place.
+    """
 
-        if v <= P.speed_min:
-            return P.speed_min
+    delta = min(max(delta, -steer_max), steer_max)
+    x, y, yaw, v = state[0], state[1], state[2], state[3]
 
-        return v
+    state[0] = x + v * math.cos(yaw) * dt
+    state[1] = y + v * math.sin(yaw) * dt
+    state[2] = yaw + v / WB * math.tan(delta) * dt
+    state[3] = min(max(v + direct * a * dt, speed_min), speed_max)
 
 
 class PATH:
     def __init__(self, cx, cy, cyaw, ck):
-        self.cx = cx
-        self.cy = cy
-        self.cyaw = cyaw
+        self.cx = np.asarray(cx, dtype=np.float64)
+        self.cy = np.asarray(cy, dtype=np.float64)
+        self.cyaw = np.asarray(cyaw, dtype=np.float64)
         self.ck = ck
         self.length = len(cx)
         self.ind_old = 0
@@ -110,22 +139,18 @@ class PATH:
         :return: nearest index, lateral distance to ref point
         """
 
-        dx = [node.x - x for x in self.cx[self.ind_old: (self.ind_old + P.N_IND)]]
-        dy = [node.y - y for y in self.cy[self.ind_old: (self.ind_old + P.N_IND)]]
-        dist = np.hypot(dx, dy)
+        ind_range = slice(self.ind_old, self.ind_old + P.N_IND)
+        dx = node.x - self.cx[ind_range]
+        dy = node.y - self.cy[ind_range]
+        dist2 = dx * dx + dy * dy  # squared distance has the same argmin
 
-        ind_in_N = int(np.argmin(dist))
+        ind_in_N = int(dist2.argmin())
         ind = self.ind_old + ind_in_N
         self.ind_old = ind
 
-        rear_axle_vec_rot_90 = np.array([[math.cos(node.yaw + math.pi / 2.0)],
-                                         [math.sin(node.yaw + math.pi / 2.0)]])
-
-        vec_target_2_rear = np.array([[dx[ind_in_N]],
-                                      [dy[ind_in_N]]])
-
-        er = np.dot(vec_target_2_rear.T, rear_axle_vec_rot_90)
-        er = er[0][0]
+        # project vector (target -> rear axle) onto the rear axle rotated by 90 deg
+        er = dx[ind_in_N] * math.cos(node.yaw + math.pi / 2.0) + \
+            dy[ind_in_N] * math.sin(node.yaw + math.pi / 2.0)
 
         return ind, er
 
@@ -165,6 +190,9 @@ def calc_ref_trajectory_in_T_step(node, ref_path, sp):
     return z_ref, ind
 
 
+_du_last = math.inf  # input change of the last iteration of the previous call
+
+
 def linear_mpc_control(z_ref, z0, a_old, delta_old):
     """
     linear mpc controller
@@ -175,21 +203,35 @@ def linear_mpc_control(z_ref, z0, a_old, delta_old):
     :return: acceleration and delta strategy based on current information
     """
 
+    global _du_last
+
     if a_old is None or delta_old is None:
-        a_old = [0.0] * P.T
-        delta_old = [0.0] * P.T
+        a_old = np.zeros(P.T)
+        delta_old = np.zeros(P.T)
+        _du_last = math.inf
+    else:
+        a_old = np.asarray(a_old, dtype=np.float64)
+        delta_old = np.asarray(delta_old, dtype=np.float64)
 
     x, y, yaw, v = None, None, None, None
 
-    for k in range(P.iter_max):
+    # warm-started from a converged strategy, one linearization is enough
+    iter_num = P.iter_min if _du_last < P.du_res else P.iter_max
+
+    for k in range(iter_num):
         z_bar = predict_states_in_T_step(z0, a_old, delta_old, z_ref)
-        a_rec, delta_rec = a_old[:], delta_old[:]
+        a_rec, delta_rec = a_old, delta_old
         a_old, delta_old, x, y, yaw, v = solve_linear_mpc(z_ref, z_bar, z0, delta_old)
 
-        du_a_max = max([abs(ia - iao) for ia, iao in zip(a_old, a_rec)])
-        du_d_max = max([abs(ide - ido) for ide, ido in zip(delta_old, delta_rec)])
+        if a_old is None:
+            _du_last = math.inf
+            break
 
-        if max(du_a_max, du_d_max) < P.du_res:
+        du_a_max = np.abs(a_old - a_rec).max()
+        du_d_max = np.abs(delta_old - delta_rec).max()
+        _du_last = max(du_a_max, du_d_max)
+
+        if _du_last < P.du_res:
             break
 
     return a_old, delta_old, x, y, yaw, v
@@ -206,53 +248,202 @@ def predict_states_in_T_step(z0, a, delta, z_ref):
     :return: predict states in T steps (z_bar, used for calc linear motion model)
     """
 
-    z_bar = z_ref * 0.0
+    z_bar = np.zeros_like(z_ref)
+    _integrate(np.asarray(z0, dtype=np.float64),
+               np.asarray(a, dtype=np.float64),
+               np.asarray(delta, dtype=np.float64),
+               P.dt, P.WB, P.steer_max, P.speed_max, P.speed_min, z_bar)
+
+    return z_bar
 
-    for i in range(P.NX):
-        z_bar[i, 0] = z0[i]
 
-    node = Node(x=z0[0], y=z0[1], v=z0[2], yaw=z0[3])
+@njit(cache=True, fastmath=True)
+def _integrate(z0, a, delta, dt, WB, steer_max, speed_max, speed_min, out):
+    """
+    roll the kinematic model (_node_step) forward from z0.
+    :param z0: initial state [x, y, v, yaw]
+    :param a: acceleration sequence
+    :param delta: steering sequence
+    :param out: states in T steps, out[:, 0] = z0
+    """
 
-    for ai, di, i in zip(a, delta, range(1, P.T + 1)):
-        node.update(ai, di, 1.0)
-        z_bar[0, i] = node.x
-        z_bar[1, i] = node.y
-        z_bar[2, i] = node.v
-        z_bar[3, i] = node.yaw
+    state = np.array([z0[0], z0[1], z0[3], z0[2]])
+    out[0, 0], out[1, 0], out[2, 0], out[3, 0] = z0[0], z0[1], z0[2], z0[3]
 
-    return z_bar
+    for i in range(min(a.shape[0], out.shape[1] - 1)):
+        _node_step(state, a[i], delta[i], 1.0, dt, WB, steer_max, speed_max, speed_min)
+        out[0, i + 1], out[1, i + 1], out[2, i + 1], out[3, i + 1] = \
+            state[0], state[1], state[3], state[2]
 
 
-def calc_linear_discrete_model(v, phi, delta):
+@njit(cache=True, fastmath=True)
+def calc_linear_discrete_model(v, phi, delta, A, B, C, dt, WB):
     """
     calc linear and discrete time dynamic model.
+    A, B, C are caller-owned buffers, only the nonzero entries are written.
     :param v: speed: v_bar
     :param phi: angle of vehicle: phi_bar
     :param delta: steering angle: delta_bar
-    :return: A, B, C
+    :param A: (NX, NX) output
+    :param B: (NX, NU) output
+    :param C: (NX,) output
+    """
+
+    c_phi = math.cos(phi)
+    s_phi = math.sin(phi)
+    c_d = math.cos(delta)
+    t_d = math.tan(delta)
+    dt_v = dt * v
+    b_d = dt_v / (WB * c_d * c_d)
+
+    A.fill(0.0)
+    B.fill(0.0)
+    C.fill(0.0)
+
+    A[0, 0] = 1.0
+    A[0, 2] = dt * c_phi
+    A[0, 3] = -dt_v * s_phi
+    A[1, 1] = 1.0
+    A[1, 2] = dt * s_phi
+    A[1, 3] = dt_v * c_phi
+    A[2, 2] = 1.0
+    A[3, 2] = dt * t_d / WB
+    A[3, 3] = 1.0
+
+    B[2, 0] = dt
+    B[3, 1] = b_d
+
+    C[0] = dt_v * s_phi * phi
+    C[1] = -dt_v * c_phi * phi
+    C[3] = -b_d * delta
+
+
+@njit(cache=True, fastmath=True)
+def _fill_ABC(v_arr, phi_arr, delta_arr, A_out, B_out, C_out, dt, WB):
+    """
+    calc linear and discrete time dynamic model of every step in T.
+    :param v_arr: speed: v_bar
+    :param phi_arr: angle of vehicle: phi_bar
+    :param delta_arr: steering angle: delta_bar
+    :param A_out: (T, NX, NX)
+    :param B_out: (T, NX, NU)
+    :param C_out: (T, NX)
+    """
+
+    for t in range(v_arr.shape[0]):
+        calc_linear_discrete_model(v_arr[t], phi_arr[t], delta_arr[t],
+                                   A_out[t], B_out[t], C_out[t], dt, WB)
+
+
+@njit(cache=True, fastmath=True)
+def calc_condensed_model(A, B, C, Phi, Gamma, w):
     """
+    eliminate the states with the linear model of every step in T:
+    z_{t+1} = A_t z_t + B_t u_t + C_t  ->  Z = Phi z0 + Gamma U + w,
+    Z = [z_1, ..., z_T], U = [u_0, ..., u_{T-1}].
+    :param A: (T, NX, NX)
+    :param B: (T, NX, NU)
+    :param C: (T, NX)
+    :param Phi: (T * NX, NX) output
+    :param Gamma: (T * NX, T * NU) output
+    :param w: (T * NX,) output
+    """
+
+    T, nx, nu = B.shape
+
+    Gamma.fill(0.0)
+
+    for t in range(T):
+        r = t * nx
+
+        for i in range(nx):
+            for j in range(nx):
+                if t == 0:
+                    Phi[i, j] = A[0, i, j]
+                else:
+                    acc = 0.0
+                    for k in range(nx):
+                        acc += A[t, i, k] * Phi[r - nx + k, j]
+                    Phi[r + i, j] = acc
+
+            for j in range(t * nu):
+                acc = 0.0
+                for k in range(nx):
+                    acc += A[t, i, k] * Gamma[r - nx + k, j]
+                Gamma[r + i, j] = acc
 
-    A = np.array([[1.0, 0.0, P.dt * math.cos(phi), - P.dt * v * math.sin(phi)],
-                  [0.0, 1.0, P.dt * math.sin(phi), P.dt * v * math.cos(phi)],
-                  [0.0, 0.0, 1.0, 0.0],
-                  [0.0, 0.0, P.dt * math.tan(delta) / P.WB, 1.0]])
+            for j in range(nu):
+                Gamma[r + i, t * nu + j] = B[t, i, j]
+
+            acc = C[t, i]
+            if t > 0:
+                for k in range(nx):
+                    acc += A[t, i, k] * w[r - nx + k]
+            w[r + i] = acc
+
+
+def build_linear_mpc_problem():
+    """
+    set up OSQP for the condensed quadratic program of the linear MPC.
+    decision vector: U = [u_0, ..., u_{T-1}], the states are given by
+    calc_condensed_model. cost: U' H U + f' U,
+    constraints: l <= M U <= u (speed of z_1..z_T, inputs, steering rate).
+    H and the speed rows of M change with the linear model, so they are
+    declared dense and each solve only updates their values.
+    :return: OSQP solver, lower / upper bounds,
+             (row, col) of the entries of H and of the speed rows of M
+    """
 
-    B = np.array([[0.0, 0.0],
-                  [0.0, 0.0],
-                  [P.dt, 0.0],
-                  [0.0, P.dt * v / (P.WB * math.cos(delta) ** 2)]])
+    n = P.NU * P.T
 
-    C = np.array([P.dt * v * math.sin(phi) * phi,
-                  -P.dt * v * math.cos(phi) * phi,
-                  0.0,
-                  -P.dt * v * delta / (P.WB * math.cos(delta) ** 2)])
+    # penalty of the stacked states z_1..z_T and of the inputs
+    Q_bar = sparse.block_diag([sparse.kron(sparse.eye(P.T - 1), P.Q), P.Qf]).toarray()
+    D = np.eye(P.T - 1, P.T, k=1) - np.eye(P.T - 1, P.T)
+    R_bar = np.kron(np.eye(P.T), P.R) + np.kron(D.T @ D, P.Rd)
 
-    return A, B, C
+    # steering rate: u_{t+1}[1] - u_t[1]
+    D_steer = np.kron(D, np.array([[0.0, 1.0]]))
+
+    H = sparse.triu(np.ones((n, n)), format='csc')
+    M = sparse.csc_matrix(np.vstack((np.ones((P.T, n)), np.eye(n), D_steer)))
+
+    H_ind = (H.indices, np.repeat(np.arange(n), np.diff(H.indptr)))
+    M_rows = M.indices
+    M_cols = np.repeat(np.arange(n), np.diff(M.indptr))
+    speed = M_rows < P.T
+    M_ind = (M_rows[speed], M_cols[speed], np.flatnonzero(speed))
+
+    l = np.hstack((np.full(P.T, P.speed_min),
+                   np.tile([-P.acceleration_max, -P.steer_max], P.T),
+                   np.full(P.T - 1, -P.steer_change_max * P.dt)))
+    u = np.hstack((np.full(P.T, P.speed_max),
+                   np.tile([P.acceleration_max, P.steer_max], P.T),
+                   np.full(P.T - 1, P.steer_change_max * P.dt)))
+
+    solver = osqp.OSQP()
+    solver.setup(H, np.zeros(n), M, l, u,
+                 verbose=False, warm_start=True, max_iter=200,
+                 eps_abs=1e-3, eps_rel=1e-3, polish=False,
+                 adaptive_rho=False, rho=0.1, sigma=1e-6)
+
+    return solver, l, u, Q_bar, R_bar, H_ind, M_ind
+
+
+# built on the first solve, so every worker process sets up its own OSQP
+_QP = None
+
+# workspace reused by every solve
+_A_buf = np.zeros((P.T, P.NX, P.NX))
+_B_buf = np.zeros((P.T, P.NX, P.NU))
+_C_buf = np.zeros((P.T, P.NX))
+_Phi = np.zeros((P.T * P.NX, P.NX))
+_Gamma = np.zeros((P.T * P.NX, P.T * P.NU))
+_w = np.zeros(P.T * P.NX)
 
 
 def solve_linear_mpc(z_ref, z_bar, z0, d_bar):
     """
-    solve the quadratic optimization problem using cvxpy, solver: OSQP
+    solve the condensed quadratic optimization problem using OSQP
     :param z_ref: reference trajectory (desired trajectory: [x, y, v, yaw])
     :param z_bar: predicted states in T steps
     :param z0: initial state
@@ -260,45 +451,48 @@ def solve_linear_mpc(z_ref, z_bar, z0, d_bar):
     :return: optimal acceleration and steering strategy
     """
 
-    z = cvxpy.Variable((P.NX, P.T + 1))
-    u = cvxpy.Variable((P.NU, P.T))
+    global _QP
 
-    cost = 0.0
-    constrains = []
+    if _QP is None:
+        _QP = build_linear_mpc_problem()
 
-    for t in range(P.T):
-        cost += cvxpy.quad_form(u[:, t], P.R)
-        cost += cvxpy.quad_form(z_ref[:, t] - z[:, t], P.Q)
+    solver, l, u, Q_bar, R_bar, H_ind, M_ind = _QP
 
-        A, B, C = calc_linear_discrete_model(z_bar[2, t], z_bar[3, t], d_bar[t])
+    _fill_ABC(z_bar[2, :P.T], z_bar[3, :P.T], np.asarray(d_bar, dtype=np.float64),
+              _A_buf, _B_buf, _C_buf, P.dt, P.WB)
+    calc_condensed_model(_A_buf, _B_buf, _C_buf, _Phi, _Gamma, _w)
 
-        constrains += [z[:, t + 1] == A @ z[:, t] + B @ u[:, t] + C]
+    # free response of the states and its error to the reference
+    z_free = _Phi @ np.asarray(z0, dtype=np.float64) + _w
+    e_free = z_free - z_ref[:, 1:].T.ravel()
 
-        if t < P.T - 1:
-            cost += cvxpy.quad_form(u[:, t + 1] - u[:, t], P.Rd)
-            constrains += [cvxpy.abs(u[1, t + 1] - u[1, t]) <= P.steer_change_max * P.dt]
+    QG = Q_bar @ _Gamma
+    H = 2.0 * (_Gamma.T @ QG + R_bar)
+    q = 2.0 * (QG.T @ e_free)
 
-    cost += cvxpy.quad_form(z_ref[:, P.T] - z[:, P.T], P.Qf)
+    l[:P.T] = P.speed_min - z_free[2::P.NX]
+    u[:P.T] = P.speed_max - z_free[2::P.NX]
 
-    constrains += [z[:, 0] == z0]
-    constrains += [z[2, :] <= P.speed_max]
-    constrains += [z[2, :] >= P.speed_min]
-    constrains += [cvxpy.abs(u[0, :]) <= P.acceleration_max]
-    constrains += [cvxpy.abs(u[1, :]) <= P.steer_max]
+    G_speed = _Gamma[2::P.NX, :]
+    rows, cols, idx = M_ind
 
-    prob = cvxpy.Problem(cvxpy.Minimize(cost), constrains)
-    prob.solve(solver=cvxpy.OSQP)
+    solver.update(Px=H[H_ind], q=q, l=l, u=u,
+                   Ax=G_speed[rows, cols], Ax_idx=idx)
+    res = solver.solve()
 
     a, delta, x, y, yaw, v = None, None, None, None, None, None
 
-    if prob.status == cvxpy.OPTIMAL or \
-            prob.status == cvxpy.OPTIMAL_INACCURATE:
-        x = z.value[0, :]
-        y = z.value[1, :]
-        v = z.value[2, :]
-        yaw = z.value[3, :]
-        a = u.value[0, :]
-        delta = u.value[1, :]
+    if res.info.status == 'solved' or \
+            res.info.status == 'solved inaccurate':
+        z = np.empty((P.NX, P.T + 1))
+        z[:, 0] = z0
+        z[:, 1:] = (z_free + _Gamma @ res.x).reshape((P.T, P.NX)).T
+        x = z[0, :]
+        y = z[1, :]
+        v = z[2, :]
+        yaw = z[3, :]
+        a = res.x[0::P.NU]
+        delta = res.x[1::P.NU]
     else:
         print("Cannot solve linear mpc!")
 
@@ -315,88 +509,207 @@ def calc_speed_profile(cx, cy, cyaw, target_speed):
     :return: speed profile
     """
 
-    speed_profile = [target_speed] * len(cx)
-    direction = 1.0  # forward
-
-    # Set stop point
-    for i in range(len(cx) - 1):
-        dx = cx[i + 1] - cx[i]
-        dy = cy[i + 1] - cy[i]
+    cx = np.asarray(cx, dtype=np.float64)
+    cy = np.asarray(cy, dtype=np.float64)
+    cyaw = np.asarray(cyaw, dtype=np.float64)
 
-        move_direction = math.atan2(dy, dx)
+    dx = np.diff(cx)
+    dy = np.diff(cy)
+    move_direction = np.arctan2(dy, dx)
+    dangle = np.abs(pi_2_pi(move_direction - cyaw[:-1]))
+    direction = np.where(dangle >= np.pi / 4.0, -1.0, 1.0)
 
-        if dx != 0.0 and dy != 0.0:
-            dangle = abs(pi_2_pi(move_direction - cyaw[i]))
-            if dangle >= math.pi / 4.0:
-                direction = -1.0
-            else:
-                direction = 1.0
+    # keep the previous direction where dx or dy is zero (forward at start)
+    ind = np.where((dx != 0.0) & (dy != 0.0), np.arange(len(dx)), -1)
+    ind = np.maximum.accumulate(ind)
+    direction = np.where(ind >= 0, direction[ind], 1.0)
 
-        if direction != 1.0:
-            speed_profile[i] = - target_speed
-        else:
-            speed_profile[i] = target_speed
-
-    speed_profile[-1] = 0.0
+    speed_profile = np.append(direction * target_speed, 0.0)
 
     return speed_profile
 
 
 def pi_2_pi(angle):
-    if angle > math.pi:
-        return angle - 2.0 * math.pi
+    """
+    wrap angle to [-pi, pi), works for scalars and numpy arrays.
+    """
+
+    return (angle + math.pi) % (2.0 * math.pi) - math.pi
+
 
-    if angle < -math.pi:
-        return angle + 2.0 * math.pi
+def calc_ref_path(ax, ay):
+    """
+    reference path (cubic spline) and speed profile through the waypoints.
+    they only depend on the waypoints, config and the code computing them,
+    so the result is cached in cache/path_<hash>.npz next to this file.
+    :param ax: x of waypoints [m]
+    :param ay: y of waypoints [m]
+    :return: cx, cy, cyaw, ck, s, speed profile
+    """
 
-    return angle
+    # the source of the spline module and of the speed profile is part of the
+    # key, so changing either invalidates the cached files
+    key = repr((list(ax), list(ay), P.d_dist, P.target_speed,
+                inspect.getsource(cs), inspect.getsource(calc_speed_profile)))
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+    cache_file = os.path.join(cache_dir,
+                              "path_" + hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as data:
+                return data["cx"], data["cy"], data["cyaw"], data["ck"], data["s"], data["sp"]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            pass  # unreadable cache file, recompute and overwrite it
+
+    cx, cy, cyaw, ck, s = cs.calc_spline_course(ax, ay, ds=P.d_dist)
+    sp = calc_speed_profile(cx, cy, cyaw, P.target_speed)
+    cx, cy, cyaw, ck, s = np.array(cx), np.array(cy), np.array(cyaw), np.array(ck), np.array(s)
+
+    # write to a temporary file first, so an interrupted run leaves no partial cache
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez_compressed(f, cx=cx, cy=cy, cyaw=cyaw, ck=ck, s=s, sp=sp)
+    os.replace(tmp_file, cache_file)
+
+    return cx, cy, cyaw, ck, s, sp
+
+
+def shift_strategy(u, k):
+    """
+    drop the first k inputs of a strategy and repeat its last input,
+    so that u_shift[0] is the input for k steps later.
+    """
+
+    k = min(k, len(u) - 1)
+
+    return np.concatenate((u[k:], np.full(k, u[-1])))
+
+
+def submit_mpc(executor, node, ref_path, sp, a_opt, delta_opt, k):
+    """
+    submit an asynchronous mpc solve whose strategy is applied P.mpc_delay
+    steps from now. the start state is predicted with the inputs that will
+    be applied until then, and the warm start is shifted to that step.
+    :param node: current state
+    :param a_opt, delta_opt: strategy being applied
+    :param k: index of the input of delta_opt applied at the current step
+    :return: future of linear_mpc_control
+    """
+
+    node_pred = Node(x=node.x, y=node.y, yaw=node.yaw, v=node.v)
+
+    for j in range(P.mpc_delay):
+        kj = min(k + j, P.T - 1)
+        node_pred.update(a_opt[kj], delta_opt[kj], 1.0)
+
+    # keep the search index of the path at the current state
+    ind_old = ref_path.ind_old
+    z_ref, _ = calc_ref_trajectory_in_T_step(node_pred, ref_path, sp)
+    ref_path.ind_old = ind_old
+
+    z0 = [node_pred.x, node_pred.y, node_pred.v, node_pred.yaw]
+    k += P.mpc_delay
+
+    return executor.submit(linear_mpc_control, z_ref, z0,
+                           shift_strategy(a_opt, k), shift_strategy(delta_opt, k))
 
 
 def main():
     ax = [0.0, 15.0, 30.0, 50.0, 60.0]
     ay = [0.0, 40.0, 15.0, 30.0, 0.0]
-    cx, cy, cyaw, ck, s = cs.calc_spline_course(
-        ax, ay, ds=P.d_dist)
-
-    sp = calc_speed_profile(cx, cy, cyaw, P.target_speed)
+    cx, cy, cyaw, ck, s, sp = calc_ref_path(ax, ay)
 
     ref_path = PATH(cx, cy, cyaw, ck)
     node = Node(x=cx[0], y=cy[0], yaw=cyaw[0], v=0.0)
 
     time = 0.0
-    x = [node.x]
-    y = [node.y]
-    yaw = [node.yaw]
-    v = [node.v]
-    t = [0.0]
-    d = [0.0]
-    a = [0.0]
+    n_max = int(math.ceil(P.time_max / P.dt)) + 2
+    x, y, yaw, v = np.empty(n_max), np.empty(n_max), np.empty(n_max), np.empty(n_max)
+    t, d, a = np.empty(n_max), np.empty(n_max), np.empty(n_max)
+    x[0], y[0], yaw[0], v[0] = node.x, node.y, node.yaw, node.v
+    t[0], d[0], a[0] = 0.0, 0.0, 0.0
+    i = 0
 
     delta_opt, a_opt = None, None
+    x_opt, y_opt = None, None
     a_exc, delta_exc = 0.0, 0.0
 
+    # by default the mpc is solved in the loop. with P.mpc_async it runs in a
+    # worker process with a latency of P.mpc_delay steps of simulated time:
+    # a solve starts from the state predicted mpc_delay steps ahead and its
+    # strategy is applied from that step on, however long the solve takes on
+    # the host, so both modes are reproducible.
+    executor = ProcessPoolExecutor(max_workers=1) if P.mpc_async else None
+    future = None
+    i_apply = 0  # step from which the running solve is applied
+    i_plan = 0  # step from which the latest strategy is applied
+
+    # static background is rendered once, the moving artists are blitted
+    fig, axes = plt.subplots()
+    fig.canvas.mpl_connect('key_release_event',
+                           lambda event:
+                           [exit(0) if event.key == 'escape' else None])
+
+    axes.plot(cx, cy, color='gray')
+    axes.margins(0.1)
+    axes.autoscale_view()
+    axes.set_autoscale_on(False)
+    axes.set_aspect("equal", adjustable="box")
+
+    line_opt, = axes.plot([], [], color='darkviolet', marker='*', animated=True)
+    line_traj, = axes.plot([], [], '-b', animated=True)
+    line_target, = axes.plot([], [], 'xg', animated=True)
+    line_car = [axes.plot([], [], 'black', animated=True)[0] for _ in range(5)]
+    line_arrow, = axes.plot([], [], color='black', linewidth=2, animated=True)
+    title = axes.set_title("Linear MPC", animated=True)
+    artists = [line_opt, line_traj, line_target, *line_car, line_arrow, title]
+
+    background = None
+
+    def on_draw(event):
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(fig.bbox)
+
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    plt.show(block=False)
+    fig.canvas.draw()
+
     while time < P.time_max:
         z_ref, target_ind = \
             calc_ref_trajectory_in_T_step(node, ref_path, sp)
 
         z0 = [node.x, node.y, node.v, node.yaw]
 
-        a_opt, delta_opt, x_opt, y_opt, yaw_opt, v_opt = \
-            linear_mpc_control(z_ref, z0, a_opt, delta_opt)
+        if executor is not None and future is not None and i == i_apply:
+            a_new, delta_new, x_new, y_new, _, _ = future.result()
+            future = None
+
+            if delta_new is not None:
+                a_opt, delta_opt, x_opt, y_opt = a_new, delta_new, x_new, y_new
+                i_plan = i
+
+        # synchronous mode, or no strategy yet in asynchronous mode
+        if executor is None or delta_opt is None:
+            a_opt, delta_opt, x_opt, y_opt, _, _ = \
+                linear_mpc_control(z_ref, z0, a_opt, delta_opt)
+            i_plan = i
+
+        if executor is not None and future is None and delta_opt is not None:
+            future = submit_mpc(executor, node, ref_path, sp, a_opt, delta_opt, i - i_plan)
+            i_apply = i + P.mpc_delay
 
         if delta_opt is not None:
-            delta_exc, a_exc = delta_opt[0], a_opt[0]
+            k = min(i - i_plan, P.T - 1)  # steps since the strategy was applied first
+            delta_exc, a_exc = delta_opt[k], a_opt[k]
 
         node.update(a_exc, delta_exc, 1.0)
         time += P.dt
 
-        x.append(node.x)
-        y.append(node.y)
-        yaw.append(node.yaw)
-        v.append(node.v)
-        t.append(time)
-        d.append(delta_exc)
-        a.append(a_exc)
+        i += 1
+        x[i], y[i], yaw[i], v[i] = node.x, node.y, node.yaw, node.v
+        t[i], d[i], a[i] = time, delta_exc, a_exc
 
         dist = math.hypot(node.x - cx[-1], node.y - cy[-1])
 
@@ -404,25 +717,32 @@ def main():
                 abs(node.v) < P.speed_stop:
             break
 
-        dy = (node.yaw - yaw[-2]) / (node.v * P.dt)
+        dy = (node.yaw - yaw[i - 1]) / (node.v * P.dt)
         steer = rs.pi_2_pi(-math.atan(P.WB * dy))
 
-        plt.cla()
-        draw.draw_car(node.x, node.y, node.yaw, steer, P)
-        plt.gcf().canvas.mpl_connect('key_release_event',
-                                     lambda event:
-                                     [exit(0) if event.key == 'escape' else None])
+        for line, shape in zip(line_car, draw.calc_car_shape(node.x, node.y, node.yaw, steer, P)):
+            line.set_data(shape[0, :], shape[1, :])
+
+        line_arrow.set_data(*draw.calc_arrow(node.x, node.y, node.yaw, P.WB * 0.6))
 
         if x_opt is not None:
-            plt.plot(x_opt, y_opt, color='darkviolet', marker='*')
+            line_opt.set_data(x_opt, y_opt)
+
+        line_traj.set_data(x[:i + 1], y[:i + 1])
+        line_target.set_data([cx[target_ind]], [cy[target_ind]])
+        title.set_text("Linear MPC, " + "v = " + str(round(node.v * 3.6, 2)))
+
+        fig.canvas.restore_region(background)
+        for artist in artists:
+            fig.draw_artist(artist)
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
 
-        plt.plot(cx, cy, color='gray')
-        plt.plot(x, y, '-b')
-        plt.plot(cx[target_ind], cy[target_ind])
-        plt.axis("equal")
-        plt.title("Linear MPC, " + "v = " + str(round(node.v * 3.6, 2)))
-        plt.pause(0.001)
+    for artist in artists:
+        artist.set_animated(False)
 
+    if executor is not None:
+        executor.shutdown()
     plt.show()
 
 
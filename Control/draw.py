@@ -5,34 +5,45 @@ import matplotlib.pyplot as plt
 
 class Arrow:
     def __init__(self, x, y, theta, L, c):
-        angle = np.deg2rad(30)
-        d = 0.4 * L
         w = 2
+        arrow_x, arrow_y = calc_arrow(x, y, theta, L)
+        plt.plot(arrow_x, arrow_y, color=c, linewidth=w)
 
-        x_start = x
-        y_start = y
-        x_end = x + L * np.cos(theta)
-        y_end = y + L * np.sin(theta)
 
-        theta_hat_L = theta + math.pi - angle
-        theta_hat_R = theta + math.pi + angle
+def calc_arrow(x, y, theta, L):
+    """
+    arrow as one polyline: start -> end -> left head -> end -> right head
+    """
 
-        x_hat_start = x_end
-        x_hat_end_L = x_hat_start + d * np.cos(theta_hat_L)
-        x_hat_end_R = x_hat_start + d * np.cos(theta_hat_R)
+    angle = np.deg2rad(30)
+    d = 0.4 * L
 
-        y_hat_start = y_end
-        y_hat_end_L = y_hat_start + d * np.sin(theta_hat_L)
-        y_hat_end_R = y_hat_start + d * np.sin(theta_hat_R)
+    x_start = x
+    y_start = y
+    x_end = x + L * np.cos(theta)
+    y_end = y + L * np.sin(theta)
 
-        plt.plot([x_start, x_end], [y_start, y_end], color=c, linewidth=w)
-        plt.plot([x_hat_start, x_hat_end_L],
-                 [y_hat_start, y_hat_end_L], color=c, linewidth=w)
-        plt.plot([x_hat_start, x_hat_end_R],
-                 [y_hat_start, y_hat_end_R], color=c, linewidth=w)
+    theta_hat_L = theta + math.pi - angle
+    theta_hat_R = theta + math.pi + angle
 
+    x_hat_start = x_end
+    x_hat_end_L = x_hat_start + d * np.cos(theta_hat_L)
+    x_hat_end_R = x_hat_start + d * np.cos(theta_hat_R)
+
+    y_hat_start = y_end
+    y_hat_end_L = y_hat_start + d * np.sin(theta_hat_L)
+    y_hat_end_R = y_hat_start + d * np.sin(theta_hat_R)
+
+    return [x_start, x_end, x_hat_end_L, x_hat_start, x_hat_end_R], \
+           [y_start, y_end, y_hat_end_L, y_hat_start, y_hat_end_R]
+
+
+def calc_car_shape(x, y, yaw, steer, C):
+    """
+    outline of the car body and its four wheels in world frame
+    :return: car, front-right, rear-right, front-left, rear-left wheel (2 x 5 each)
+    """
 
-def draw_car(x, y, yaw, steer, C, color='black'):
     car = np.array([[-C.RB, -C.RB, C.RF, C.RF, -C.RB],
                     [C.W / 2, -C.W / 2, -C.W / 2, C.W / 2, C.W / 2]])
 
@@ -71,6 +82,12 @@ def draw_car(x, y, yaw, steer, C, color='black'):
     rlWheel += np.array([[x], [y]])
     car += np.array([[x], [y]])
 
+    return car, frWheel, rrWheel, flWheel, rlWheel
+
+
+def draw_car(x, y, yaw, steer, C, color='black'):
+    car, frWheel, rrWheel, flWheel, rlWheel = calc_car_shape(x, y, yaw, steer, C)
+
     plt.plot(car[0, :], car[1, :], color)
     plt.plot(frWheel[0, :], frWheel[1, :], color)
     plt.plot(rrWheel[0, :], rrWheel[1, :], color)